@@ -1,11 +1,16 @@
-import json
+import asyncio
 import logging
 import os
+import re
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set
 
-import requests
-from fastapi import FastAPI, Request, Response
+import aiosqlite
+import httpx
+import orjson
+from fastapi import BackgroundTasks, FastAPI, Request, Response
+from fastapi.responses import ORJSONResponse
 
 
 def get_env(name: str, default: str = "") -> str:
@@ -18,76 +23,261 @@ if not BOT_TOKEN:
 
 MESSAGE_TEXT = get_env("MESSAGE_TEXT", "Отметь атт https://lms.astanait.edu.kz/")
 
-# Optional: for /tick_test only
+SEND_URL = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
+COPY_URL = f"https://api.telegram.org/bot{BOT_TOKEN}/copyMessage"
+JSON_HEADERS = {"content-type": "application/json"}
+
+# Optional: for /tick_test, and as the source chat /tick copies the reminder from
 ADMIN_CHAT_ID = get_env("ADMIN_CHAT_ID", "")
+try:
+    ADMIN_CHAT_ID_INT: Optional[int] = int(ADMIN_CHAT_ID) if ADMIN_CHAT_ID else None
+except ValueError:
+    ADMIN_CHAT_ID_INT = None
+
+DB_PATH = Path("subscribers.db")
 
+# Legacy JSON store, imported into DB_PATH on first start.
 SUBSCRIBERS_PATH = Path("subscribers.json")
 
+# Chat ids stored as strings in the legacy JSON file.
+_INT_RE = re.compile(r"-?\d+")
+
+# Max in-flight sendMessage calls during /tick (Telegram allows ~30 msg/s).
+TICK_CONCURRENCY = 25
+
+# Telegram send limits: ~30 msg/s overall, 20 msg/min per group chat.
+GLOBAL_RATE = 30
+GROUP_RATE_PER_MIN = 20
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("reminderbot")
 
-app = FastAPI()
+# Shared Telegram client and subscriber store; both are opened once in
+# lifespan() and reused by every request, so the TLS connection stays warm.
+client: Optional[httpx.AsyncClient] = None
+db: Optional[aiosqlite.Connection] = None
+
+# Serializes subscriber writes so each statement is committed on its own;
+# the connection is shared, so without it one handler's commit could flush
+# (or, on failure, drop) another handler's pending write.
+_SUBS_LOCK = asyncio.Lock()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    global client, db
+    # With HTTP/2, concurrent sends are multiplexed over one connection.
+    client = httpx.AsyncClient(
+        timeout=10,
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=50),
+    )
+
+    db = await aiosqlite.connect(DB_PATH)
+    await db.execute("PRAGMA journal_mode=WAL")
+    await db.execute("CREATE TABLE IF NOT EXISTS subs(id INTEGER PRIMARY KEY)")
+    await db.commit()
+    await import_legacy_subscribers()
+    try:
+        yield
+    finally:
+        await db.close()
+        await client.aclose()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 
-def load_subscribers() -> List[int]:
+def load_subscribers() -> Optional[Set[int]]:
+    """Parse subscribers.json; return None if the file exists but is unreadable."""
     if not SUBSCRIBERS_PATH.exists():
-        return []
+        return set()
     try:
-        with SUBSCRIBERS_PATH.open("r", encoding="utf-8") as f:
-            data = json.load(f)
-        out: List[int] = []
+        data = orjson.loads(SUBSCRIBERS_PATH.read_bytes())
+        if not isinstance(data, list):
+            raise ValueError(f"expected a JSON list, got {type(data).__name__}")
+        out: Set[int] = set()
         for x in data:
             if isinstance(x, int):
-                out.append(x)
-            elif isinstance(x, str) and x.lstrip("-").isdigit():
-                out.append(int(x))
-        # remove duplicates while preserving order
-        seen = set()
-        uniq = []
-        for cid in out:
-            if cid not in seen:
-                seen.add(cid)
-                uniq.append(cid)
-        return uniq
+                out.add(x)
+            elif isinstance(x, str) and _INT_RE.fullmatch(x):
+                out.add(int(x))
+        return out
     except Exception as exc:
         logger.warning("Failed to load subscribers: %s", exc)
-        return []
+        return None
 
 
-def save_subscribers(chat_ids: List[int]) -> None:
-    try:
-        with SUBSCRIBERS_PATH.open("w", encoding="utf-8") as f:
-            json.dump(chat_ids, f)
-    except Exception as exc:
-        logger.error("Failed to save subscribers: %s", exc)
-
+async def import_legacy_subscribers() -> None:
+    """
+    One-time migration of subscribers.json into the database.
 
-def add_subscriber(chat_id: int) -> None:
+    The file is renamed afterwards so unsubscribed users are not re-imported
+    on the next start. A file that fails to parse is left in place.
+    """
+    if not SUBSCRIBERS_PATH.exists():
+        return
     subs = load_subscribers()
-    if chat_id not in subs:
-        subs.append(chat_id)
-        save_subscribers(subs)
+    if subs is None:
+        logger.error("Not importing %s; fix or remove it and restart", SUBSCRIBERS_PATH)
+        return
+    await db.executemany("INSERT OR IGNORE INTO subs VALUES (?)", [(cid,) for cid in subs])
+    # Commit before renaming, so a failure leaves the file to retry from.
+    await db.commit()
+    SUBSCRIBERS_PATH.rename(SUBSCRIBERS_PATH.with_suffix(".json.migrated"))
+    logger.info("Imported %d subscriber(s) from %s", len(subs), SUBSCRIBERS_PATH)
+
+
+async def add_subscriber(chat_id: int) -> None:
+    async with _SUBS_LOCK:
+        cur = await db.execute("INSERT OR IGNORE INTO subs VALUES (?)", (chat_id,))
+        await db.commit()
+    if cur.rowcount:
         logger.info("Added subscriber %s", chat_id)
 
 
-def remove_subscriber(chat_id: int) -> None:
-    subs = load_subscribers()
-    if chat_id in subs:
-        subs.remove(chat_id)
-        save_subscribers(subs)
+async def remove_subscriber(chat_id: int) -> None:
+    async with _SUBS_LOCK:
+        cur = await db.execute("DELETE FROM subs WHERE id = ?", (chat_id,))
+        await db.commit()
+    if cur.rowcount:
         logger.info("Removed subscriber %s", chat_id)
 
 
-def send_message(chat_id: int, text: str) -> bool:
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-    payload = {"chat_id": chat_id, "text": text}
+async def count_subscribers() -> int:
+    async with db.execute("SELECT COUNT(*) FROM subs") as cur:
+        row = await cur.fetchone()
+    return row[0] if row else 0
+
+
+async def list_subscribers() -> List[int]:
+    async with db.execute("SELECT id FROM subs") as cur:
+        return [cid async for (cid,) in cur]
+
+
+class _Throttle:
+    """Spaces calls at least `interval` seconds apart; can be paused on 429."""
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self._next = 0.0
+        self._paused_until = 0.0
+
+    async def wait(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # A pause may have started while we slept; if so, take a new slot after it.
+            if loop.time() >= self._paused_until:
+                return
+
+    def pause(self, seconds: float) -> None:
+        until = asyncio.get_running_loop().time() + seconds
+        self._paused_until = max(self._paused_until, until)
+        self._next = max(self._next, self._paused_until)
+
+
+_global_throttle = _Throttle(1 / GLOBAL_RATE)
+_group_throttles: Dict[int, _Throttle] = {}
+
+
+async def _post(url: str, chat_id: int, body: bytes) -> httpx.Response:
+    # Negative chat ids are groups and channels, which have a tighter limit.
+    if chat_id < 0:
+        throttle = _group_throttles.get(chat_id)
+        if throttle is None:
+            throttle = _group_throttles[chat_id] = _Throttle(60 / GROUP_RATE_PER_MIN)
+        await throttle.wait()
+    await _global_throttle.wait()
+    return await client.post(url, content=body, headers=JSON_HEADERS)
+
+
+def _retry_after(r: httpx.Response) -> float:
+    try:
+        return float(orjson.loads(r.content)["parameters"]["retry_after"])
+    except Exception:
+        return 1.0
+
+
+async def _call(url: str, chat_id: int, payload: Dict[str, Any]) -> Optional[httpx.Response]:
+    """POST a Bot API method for chat_id; return the response, or None on failure."""
     try:
-        r = requests.post(url, json=payload, timeout=10)
-        r.raise_for_status()
-        return True
+        # Encode with orjson ourselves instead of going through httpx's json= path.
+        body = orjson.dumps(payload)
+        r = await _post(url, chat_id, body)
+        if r.status_code == 429:
+            # Hold every sender back, not just this one, then retry once.
+            retry_after = _retry_after(r)
+            logger.warning("Rate limited sending to %s, retrying in %.0fs", chat_id, retry_after)
+            _global_throttle.pause(retry_after)
+            r = await _post(url, chat_id, body)
     except Exception as exc:
         logger.error("Failed to send message to %s: %s", chat_id, exc)
-        return False
+        return None
+    # Only the status matters on success; the body is left undecoded.
+    if r.status_code >= 400:
+        logger.error("Failed to send message to %s: HTTP %d", chat_id, r.status_code)
+        return None
+    return r
+
+
+async def send_message(chat_id: int, text: str) -> bool:
+    return await _call(SEND_URL, chat_id, {"chat_id": chat_id, "text": text}) is not None
+
+
+async def copy_message(chat_id: int, from_chat_id: int, message_id: int) -> bool:
+    payload = {"chat_id": chat_id, "from_chat_id": from_chat_id, "message_id": message_id}
+    return await _call(COPY_URL, chat_id, payload) is not None
+
+
+async def broadcast(chat_ids: List[int], deliver: Callable[[int], Awaitable[bool]]) -> int:
+    """Run deliver for every chat concurrently; return number of successful sends."""
+    sem = asyncio.Semaphore(TICK_CONCURRENCY)
+
+    async def _send(cid: int) -> bool:
+        async with sem:
+            return await deliver(cid)
+
+    results = await asyncio.gather(*(_send(cid) for cid in chat_ids), return_exceptions=True)
+    sent = 0
+    for cid, res in zip(chat_ids, results):
+        if isinstance(res, BaseException):
+            logger.error("Broadcast to %s failed: %s", cid, res)
+        elif res:
+            sent += 1
+    return sent
+
+
+async def broadcast_reminder(subs: List[int]) -> int:
+    """
+    Send MESSAGE_TEXT to all subs; return number of successful sends.
+
+    If ADMIN_CHAT_ID is subscribed, the admin's copy is sent first and
+    everyone else gets a copyMessage of it, so each request carries only ids
+    instead of the full text. Otherwise every chat gets a plain sendMessage.
+    """
+    pending = subs
+    sent = 0
+    source_id: Optional[int] = None
+    if ADMIN_CHAT_ID_INT is not None and ADMIN_CHAT_ID_INT in subs:
+        payload = {"chat_id": ADMIN_CHAT_ID_INT, "text": MESSAGE_TEXT}
+        r = await _call(SEND_URL, ADMIN_CHAT_ID_INT, payload)
+        if r is not None:
+            sent = 1
+            pending = [cid for cid in subs if cid != ADMIN_CHAT_ID_INT]
+            try:
+                source_id = int(orjson.loads(r.content)["result"]["message_id"])
+            except Exception as exc:
+                logger.warning("No message_id in sendMessage response: %s", exc)
+
+    if source_id is None:
+        return sent + await broadcast(pending, lambda cid: send_message(cid, MESSAGE_TEXT))
+    admin_id = ADMIN_CHAT_ID_INT
+    return sent + await broadcast(pending, lambda cid: copy_message(cid, admin_id, source_id))
 
 
 def parse_message(update: Dict[str, Any]) -> Optional[Dict[str, Any]]:
@@ -97,9 +287,38 @@ def parse_message(update: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     return None
 
 
+# Command handlers. Replies are sent after the 200 is returned so Telegram
+# does not wait on our own outbound call.
+async def _handle_start(cid: int, bg: BackgroundTasks) -> None:
+    await add_subscriber(cid)
+    bg.add_task(send_message, cid, "Подписка активна. Напоминания будут приходить по расписанию.")
+
+
+async def _handle_stop(cid: int, bg: BackgroundTasks) -> None:
+    await remove_subscriber(cid)
+    bg.add_task(send_message, cid, "Вы отписались от напоминаний.")
+
+
+async def _handle_count(cid: int, bg: BackgroundTasks) -> None:
+    count = await count_subscribers()
+    bg.add_task(send_message, cid, f"Подписчиков: {count}")
+
+
+async def _handle_whoami(cid: int, bg: BackgroundTasks) -> None:
+    bg.add_task(send_message, cid, f"Ваш chat_id: {cid}")
+
+
+HANDLERS: Dict[str, Callable[[int, BackgroundTasks], Awaitable[None]]] = {
+    "/start": _handle_start,
+    "/stop": _handle_stop,
+    "/count": _handle_count,
+    "/whoami": _handle_whoami,
+}
+
+
 @app.post("/webhook")
-async def webhook(request: Request) -> Dict[str, Any]:
-    update = await request.json()
+async def webhook(request: Request, bg: BackgroundTasks) -> Dict[str, Any]:
+    update = orjson.loads(await request.body())
     msg = parse_message(update)
     if not msg:
         return {"ok": True}
@@ -115,54 +334,45 @@ async def webhook(request: Request) -> Dict[str, Any]:
 
     cid = int(chat_id)
 
-    # Commands
-    if text.startswith("/start"):
-        add_subscriber(cid)
-        send_message(cid, "Подписка активна. Напоминания будут приходить по расписанию.")
-        return {"ok": True}
-
-    if text.startswith("/stop"):
-        remove_subscriber(cid)
-        send_message(cid, "Вы отписались от напоминаний.")
-        return {"ok": True}
-
-    if text.startswith("/count"):
-        subs = load_subscribers()
-        send_message(cid, f"Подписчиков: {len(subs)}")
-        return {"ok": True}
-
-    if text.startswith("/whoami"):
-        send_message(cid, f"Ваш chat_id: {cid}")
-        return {"ok": True}
+    # Commands: first token, with any @botname suffix stripped
+    parts = text.split(None, 1)
+    cmd = parts[0].split("@", 1)[0] if parts else ""
+    handler = HANDLERS.get(cmd)
+    if handler is not None:
+        await handler(cid, bg)
 
     return {"ok": True}
 
 
-@app.get("/health")
-async def health() -> Dict[str, Any]:
-    return {"ok": True}
-
+@app.get("/health", response_class=Response)
+async def health() -> Response:
+    return Response(status_code=204)
 
-@app.get("/tick")
-async def tick() -> Response:
-    """
-    Send reminder to ALL subscribers.
 
-    IMPORTANT: Always return 204 No Content (empty body) to avoid cron-job.org
-    failures like "output too large", even if something goes wrong.
-    """
+async def run_tick() -> None:
     try:
-        subs = load_subscribers()
+        subs = await list_subscribers()
         if subs:
-            for cid in subs:
-                send_message(int(cid), MESSAGE_TEXT)
-            logger.info("Tick sent to %d subscriber(s)", len(subs))
+            sent = await broadcast_reminder(subs)
+            logger.info("Tick sent to %d/%d subscriber(s)", sent, len(subs))
         else:
             logger.info("Tick: no subscribers")
     except Exception as exc:
         # Do not return error body; just log.
         logger.error("Tick failed: %s", exc)
 
+
+@app.get("/tick")
+async def tick(bg: BackgroundTasks) -> Response:
+    """
+    Send reminder to ALL subscribers.
+
+    IMPORTANT: Always return 204 No Content (empty body) to avoid cron-job.org
+    failures like "output too large", even if something goes wrong.
+    The broadcast runs after the response is sent, so the caller gets its
+    204 without waiting on Telegram.
+    """
+    bg.add_task(run_tick)
     return Response(status_code=204)
 
 
@@ -173,10 +383,10 @@ async def tick_test() -> Response:
     Returns empty response.
     """
     try:
-        if ADMIN_CHAT_ID and ADMIN_CHAT_ID.lstrip("-").isdigit():
-            send_message(int(ADMIN_CHAT_ID), MESSAGE_TEXT)
-            return Response(status_code=204)
-        return Response(status_code=400)
+        if ADMIN_CHAT_ID_INT is None:
+            return Response(status_code=400)
+        await send_message(ADMIN_CHAT_ID_INT, MESSAGE_TEXT)
+        return Response(status_code=204)
     except Exception as exc:
         logger.error("Tick_test failed: %s", exc)
         return Response(status_code=204)